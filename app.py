@@ -1,22 +1,98 @@
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import json
+import logging
 import os
 import tempfile
 import uuid
 import subprocess
+from collections.abc import AsyncIterator
 from pathlib import Path
 
-import requests
+import aiohttp
+import httpx
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, HttpUrl
 
+logger = logging.getLogger(__name__)
+
 CLOUD_NAME = os.environ.get("CLOUDINARY_CLOUD_NAME")
 UPLOAD_PRESET = os.environ.get("CLOUDINARY_UPLOAD_PRESET")  # unsigned preset name
 FOLDER = os.environ.get("CLOUDINARY_FOLDER", "reels_with_music")
+UPLOAD_URL = f"https://api.cloudinary.com/v1_1/{CLOUD_NAME}/video/upload"
+
+CPU_COUNT = os.cpu_count() or 4
+FFMPEG_THREADS = min(CPU_COUNT, 4)  # x264 scales well up to ~4 threads per stream
+# Run only as many ffmpegs at once as there are cores for; extra requests queue
+# instead of oversubscribing the CPU and slowing every encode down
+FFMPEG_SEM = asyncio.Semaphore(max(1, CPU_COUNT // FFMPEG_THREADS))
+X264_PRESET = os.environ.get("X264_PRESET", "veryfast")
+X264_TUNE = os.environ.get("X264_TUNE")  # e.g. "zerolatency" on memory-constrained hosts
+FFMPEG_HWACCEL = os.environ.get("FFMPEG_HWACCEL", "auto")  # auto | none | cuda | vaapi
+VAAPI_DEVICE = os.environ.get("VAAPI_DEVICE", "/dev/dri/renderD128")
+
+# Output video spec; inputs already in this format can be stream-copied
+TARGET_WIDTH = 720
+TARGET_HEIGHT = 1280
+TARGET_FPS = 30
+
+FFMPEG_BASE_ARGS = ("ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-nostats")
+# setsar=1: concat rejects inputs whose sample aspect ratios differ, and forcing
+# 720x1280 onto a non-9:16 source leaves a non-square SAR
+VIDEO_NORMALIZE = f"scale={TARGET_WIDTH}:{TARGET_HEIGHT}:flags=bicubic,setsar=1,fps={TARGET_FPS},format=yuv420p"
+
+# Opt-in: Docker's default /dev/shm is only 64 MB, so raise --shm-size before enabling
+USE_TMPFS = os.environ.get("USE_TMPFS", "").lower() in ("1", "true", "yes")
+TMP_ROOT = "/dev/shm" if USE_TMPFS and os.path.isdir("/dev/shm") else None
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Per connect/read rather than total, since the audio body is read for as long as ffmpeg runs;
+# connect also bounds the wait for a free slot in the connection pool
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=60, sock_connect=60, sock_read=60)
+
+# Normalized CTA videos, keyed by URL + normalize chain, so repeat CTAs skip the download and scale.
+# Set CTA_CACHE_DIR to an empty string to disable.
+_cta_cache_dir = os.environ.get("CTA_CACHE_DIR", "/var/cache/merger")
+CTA_CACHE_DIR = Path(_cta_cache_dir) if _cta_cache_dir else None
+CTA_CACHE_MAX_FILES = int(os.environ.get("CTA_CACHE_MAX_FILES", "64"))
+if CTA_CACHE_DIR is not None:
+    try:
+        CTA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        CTA_CACHE_DIR = None
+
+# ISO BMFF (mp4/m4a/mov) may keep its index after the samples, which ffmpeg can't
+# seek to on a pipe; audio starting with one of these boxes goes through a temp file
+ISO_BMFF_BOXES = (b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide")
+
+# Piped audio can't be seeked, so loop it in the filter graph instead of -stream_loop
+AUDIO_LOOP = "aloop=loop=-1:size=2147483647,asetpts=N/SR/TB"
 
 if not CLOUD_NAME or not UPLOAD_PRESET:
     # We don't raise here to allow boot, but requests will fail clearly.
     pass
 
-app = FastAPI()
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled session for all downloads so repeat hosts reuse keep-alive connections
+    connector = aiohttp.TCPConnector(limit=16)
+    # Uploads all go to Cloudinary, so keep one warm HTTP/2 connection for them
+    limits = httpx.Limits(max_keepalive_connections=16)
+    async with (
+        aiohttp.ClientSession(connector=connector, timeout=DOWNLOAD_TIMEOUT) as session,
+        httpx.AsyncClient(http2=True, limits=limits, timeout=120) as upload_client,
+    ):
+        app.state.http = session
+        app.state.upload = upload_client
+        yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 class MergeRequest(BaseModel):
     main_video_url: HttpUrl
@@ -25,128 +101,520 @@ class MergeRequest(BaseModel):
     main_duration_sec: int = 4
     cta_duration_sec: int = 4
     music_volume: float = 0.15
+    transition: bool = True
 
 
-def _download(url: str, out_path: Path) -> None:
-    with requests.get(url, stream=True, timeout=60) as r:
+async def _download(session: aiohttp.ClientSession, url: str, out_path: Path) -> None:
+    loop = asyncio.get_running_loop()
+    async with session.get(str(url)) as r:
         r.raise_for_status()
         with open(out_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
+            async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                # Local disk writes block, keep them off the event loop
+                await loop.run_in_executor(None, f.write, chunk)
+
+
+def _cache_mtime(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return 0.0  # already evicted by a concurrent request; sort it as oldest
+
+
+def _evict_cta_cache() -> None:
+    # Least recently used first; hits refresh the mtime
+    cached = sorted(CTA_CACHE_DIR.glob("*.mp4"), key=_cache_mtime, reverse=True)
+    for path in cached[CTA_CACHE_MAX_FILES:]:
+        path.unlink(missing_ok=True)
+
+
+async def _fetch_cta(session: aiohttp.ClientSession, url: str, work_path: Path) -> Path:
+    """
+    Return a local copy of the CTA video. With the cache enabled this is a
+    normalized (output spec, no audio) file shared across requests. It is our own
+    x264 output, so it only qualifies for stream copy if its parameter sets
+    happen to match the main clip's.
+    """
+    if CTA_CACHE_DIR is None:
+        await _download(session, url, work_path)
+        return work_path
+
+    # Keyed on the normalize chain too, so entries made with an older chain aren't reused
+    key = hashlib.sha1(f"{url}|{VIDEO_NORMALIZE}".encode()).hexdigest()
+    cached = CTA_CACHE_DIR / f"{key}.mp4"
+    try:
+        os.utime(cached)
+        return cached
+    except FileNotFoundError:
+        pass  # miss, or evicted between requests
+
+    await _download(session, url, work_path)
+    # Write under a unique name and rename, so concurrent misses never see a partial file
+    part = CTA_CACHE_DIR / f"{key}.{uuid.uuid4().hex}.part"
+    cmd = [
+        *FFMPEG_BASE_ARGS,
+        "-i", str(work_path),
+        "-vf", VIDEO_NORMALIZE,
+        "-an",
+        "-threads", str(FFMPEG_THREADS),
+        "-c:v", "libx264",
+        "-preset", X264_PRESET,
+        "-crf", "20",                           # re-encoded again per request, keep it clean
+        "-pix_fmt", "yuv420p",
+        "-movflags", "+faststart",
+        "-f", "mp4",
+        str(part),
+    ]
+    try:
+        async with FFMPEG_SEM:
+            await _run_ffmpeg(cmd)
+        os.replace(part, cached)
+    finally:
+        part.unlink(missing_ok=True)
+    _evict_cta_cache()
+    return cached
+
+
+def _probe(path: Path) -> dict:
+    """
+    Return codec, size, frame rate, pixel format and H.264 parameter-set details
+    of the first video stream, plus the container duration in seconds (None if unknown).
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_data_hash", "sha256",
+        "-show_entries",
+        "stream=codec_name,width,height,r_frame_rate,pix_fmt,profile,level,has_b_frames,extradata_hash"
+        ":format=duration",
+        "-of", "json",
+        str(path),
+    ]
+    p = subprocess.run(cmd, capture_output=True, text=True)
+    if p.returncode != 0:
+        raise RuntimeError(f"FFprobe failed:\n{p.stderr[-2000:]}")
+    out = json.loads(p.stdout)
+    info = (out.get("streams") or [{}])[0]
+    duration = out.get("format", {}).get("duration")
+    info["duration"] = float(duration) if duration not in (None, "N/A") else None
+    return info
+
+
+def _matches_output_spec(info: dict) -> bool:
+    return (
+        info.get("codec_name") == "h264"
+        and info.get("width") == TARGET_WIDTH
+        and info.get("height") == TARGET_HEIGHT
+        and info.get("r_frame_rate") == f"{TARGET_FPS}/1"
+        and info.get("pix_fmt") == "yuv420p"
+    )
+
+
+def _same_parameter_sets(a: dict, b: dict) -> bool:
+    # MP4 keeps one SPS/PPS (the first clip's avcC), so stream-copied clips must share
+    # it exactly or the second one decodes garbled without any error
+    return a.get("extradata_hash") is not None and all(
+        a.get(k) == b.get(k) for k in ("profile", "level", "has_b_frames", "extradata_hash")
+    )
+
+
+def _hw_global_args(hw: str | None) -> list[str]:
+    if hw == "vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE]
+    return []
+
+
+def _hw_upload_filter(hw: str | None) -> str:
+    # NVENC takes system-memory frames directly; VA-API needs them uploaded
+    if hw == "vaapi":
+        return ",format=nv12,hwupload"
+    return ""
+
+
+def _video_encode_args(hw: str | None) -> list[str]:
+    if hw == "cuda":
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "28", "-b:v", "0", "-pix_fmt", "yuv420p"]
+    if hw == "vaapi":
+        return ["-c:v", "h264_vaapi", "-qp", "28"]
+    return [
+        "-threads", str(FFMPEG_THREADS),
+        "-c:v", "libx264",
+        "-preset", X264_PRESET,                 # ~half the bitrate of ultrafast at same crf
+        *(["-tune", X264_TUNE] if X264_TUNE else []),
+        "-crf", "28",                           # slightly lower quality for low RAM
+        "-pix_fmt", "yuv420p",
+    ]
+
+
+def _detect_hw_encoder() -> str | None:
+    """
+    Pick a hardware H.264 encoder that actually works on this host, or None for libx264.
+    A build listing a hwaccel doesn't mean the device is present, so each
+    candidate is checked with a tiny test encode.
+    """
+    if FFMPEG_HWACCEL == "none":
+        return None
+    candidates = ["cuda", "vaapi"] if FFMPEG_HWACCEL == "auto" else [FFMPEG_HWACCEL]
+
+    try:
+        p = subprocess.run(["ffmpeg", "-hide_banner", "-hwaccels"], capture_output=True, text=True)
+    except FileNotFoundError:
+        return None
+    available = p.stdout.split()
+
+    for hw in candidates:
+        if hw not in available:
+            continue
+        cmd = [
+            "ffmpeg", "-hide_banner", "-v", "error",
+            *_hw_global_args(hw),
+            "-f", "lavfi", "-i", f"color=s={TARGET_WIDTH}x{TARGET_HEIGHT}:d=0.1",
+            "-vf", f"format=yuv420p{_hw_upload_filter(hw)}",
+            *_video_encode_args(hw),
+            "-f", "null", "-",
+        ]
+        if subprocess.run(cmd, capture_output=True).returncode == 0:
+            return hw
+    return None
+
+
+HW_ENCODER = _detect_hw_encoder()
 
 
-def _run_ffmpeg_two_videos(
+async def _read_head(stream: aiohttp.StreamReader, n: int) -> bytes:
+    head = b""
+    while len(head) < n and (chunk := await stream.read(n - len(head))):
+        head += chunk
+    return head
+
+
+async def _fetch_seekable_audio(session: aiohttp.ClientSession, url: str, work_path: Path) -> Path | None:
+    """
+    Download the audio to work_path if ffmpeg will need to seek in it (ISO BMFF),
+    otherwise return None so it can be piped later. Sniffing uses a tiny Range
+    request, so this runs alongside the video downloads without an encode slot.
+    """
+    headers = {"Range": "bytes=0-7", "Connection": "close"}
+    async with session.get(str(url), headers=headers) as r:
+        r.raise_for_status()
+        head = await _read_head(r.content, 8)
+        r.close()  # the server may have ignored Range; drop the rest of the body
+    if head[4:8] not in ISO_BMFF_BOXES:
+        return None
+    await _download(session, url, work_path)
+    return work_path
+
+
+async def _feed_stdin(stdin: asyncio.StreamWriter, chunks: AsyncIterator[bytes]) -> None:
+    try:
+        async for chunk in chunks:
+            stdin.write(chunk)
+            await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg exits once it has read enough audio for the output duration
+        pass
+    finally:
+        stdin.close()
+
+
+async def _run_ffmpeg(cmd: list[str], audio: AsyncIterator[bytes] | None = None) -> None:
+    """
+    Run ffmpeg while piping the audio download straight into its stdin,
+    so encoding starts without waiting for the whole song to arrive.
+    Callers hold FFMPEG_SEM around this.
+    """
+    p = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if audio is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    feeder = asyncio.create_task(_feed_stdin(p.stdin, audio)) if audio is not None else None
+    # Keep only the tail of stderr rather than buffering the whole log
+    tail = collections.deque(maxlen=40)
+    try:
+        async for line in p.stderr:
+            tail.append(line)
+        await p.wait()
+    finally:
+        if feeder is not None:
+            feeder.cancel()
+        if p.returncode is None:
+            p.kill()
+            # Reap it even when cancelled, so no zombie or unclosed transport is left
+            with contextlib.suppress(asyncio.CancelledError):
+                await asyncio.shield(p.wait())
+    if feeder is not None:
+        with contextlib.suppress(asyncio.CancelledError):
+            await feeder  # re-raises download errors
+
+    if p.returncode != 0:
+        stderr = b"".join(tail).decode(errors="replace")
+        raise RuntimeError(f"FFmpeg failed:\n{stderr[-2000:]}")
+
+
+def _audio_input(audio: Path | AsyncIterator[bytes]) -> str:
+    return str(audio) if isinstance(audio, Path) else "pipe:0"
+
+
+async def _run_ffmpeg_concat_copy(
     main_video: Path,
     cta_video: Path,
-    audio_in: Path,
+    audio: Path | AsyncIterator[bytes],
     out_mp4: Path,
     main_dur: int,
     cta_dur: int,
     volume: float
 ) -> None:
     """
-    Merge main video + CTA video with fade transition and background audio.
-    Memory-efficient version suitable for low-RAM instances.
+    Hard-cut main video + CTA video without re-encoding the video stream.
+    Only valid when both inputs already match the output spec.
     """
-    fade_duration = 1.0
     total_duration = main_dur + cta_dur
+
+    concat_list = out_mp4.parent / "concat.txt"
+    concat_list.write_text(
+        f"file '{main_video}'\noutpoint {main_dur}\n"
+        f"file '{cta_video}'\noutpoint {cta_dur}\n"
+    )
+
+    cmd = [
+        *FFMPEG_BASE_ARGS,
+        "-f", "concat", "-safe", "0", "-i", str(concat_list),
+        "-i", _audio_input(audio),
+        "-map", "0:v",
+        "-map", "1:a",
+        "-t", str(total_duration),
+        "-c:v", "copy",
+        "-af", f"{AUDIO_LOOP},volume={volume}",
+        "-c:a", "aac",
+        "-b:a", "128k",
+        "-shortest",
+        "-movflags", "+faststart",              # moov up front so Cloudinary can start early
+        str(out_mp4),
+    ]
+
+    await _run_ffmpeg(cmd, None if isinstance(audio, Path) else audio)
+
+
+@functools.lru_cache(maxsize=256)
+def _filter_graph(
+    main_dur: int,
+    volume: float,
+    transition: bool,
+    fade_duration: float,
+    cta_normalized: bool
+) -> str:
+    """
+    Build the -filter_complex graph; only these few values vary between requests.
+    """
     fade_offset = max(0.0, main_dur - fade_duration)
+    upload = _hw_upload_filter(HW_ENCODER)
+    # A cached CTA is already scaled; fps only aligns its timebase with the main video
+    # and setsar keeps the hard-cut concat from rejecting a mismatched SAR
+    cta_chain = f"setsar=1,fps={TARGET_FPS}" if cta_normalized else VIDEO_NORMALIZE
+
+    # A main clip no longer than the fade would be all transition; hard-cut instead
+    if transition and main_dur > fade_duration:
+        video_graph = (
+            f"[0:v]{VIDEO_NORMALIZE}[v0];"
+            f"[1:v]{cta_chain}[v1];"
+            # Crossfade transition
+            f"[v0][v1]xfade=transition=fade:duration={fade_duration}:offset={fade_offset}{upload}[v];"
+        )
+    else:
+        video_graph = (
+            f"[0:v]trim=duration={main_dur},setpts=PTS-STARTPTS,{VIDEO_NORMALIZE}[v0];"
+            f"[1:v]{cta_chain}[v1];"
+            f"[v0][v1]concat=n=2:v=1:a=0{upload}[v];"
+        )
+    return video_graph + f"[2:a]{AUDIO_LOOP},volume={volume}[a]"
+
+
+async def _run_ffmpeg_two_videos(
+    main_video: Path,
+    cta_video: Path,
+    audio: Path | AsyncIterator[bytes],
+    out_mp4: Path,
+    main_dur: int,
+    cta_dur: int,
+    volume: float,
+    transition: bool = True,
+    fade_duration: float = 1.0,
+    cta_source_dur: float | None = None,
+    cta_normalized: bool = False
+) -> None:
+    """
+    Merge main video + CTA video with fade transition (or a hard cut) and background audio.
+    Memory-efficient version suitable for low-RAM instances.
+    """
+    total_duration = main_dur + cta_dur
+
+    # Only loop the CTA when it's known to be shorter than the span it has to cover
+    loop_cta = cta_source_dur is None or cta_source_dur < cta_dur + fade_duration
 
     cmd = [
-        "ffmpeg",
-        "-y",
-        "-i", str(main_video),
-        "-stream_loop", "-1", "-i", str(cta_video),   # loop CTA in case it's shorter
-        "-stream_loop", "-1", "-i", str(audio_in),
-        "-filter_complex",
-        # Video filters: scale, fps, format
-        "[0:v]scale=720:1280:flags=bicubic,fps=30,format=yuv420p[v0];"
-        "[1:v]scale=720:1280:flags=bicubic,fps=30,format=yuv420p[v1];"
-        # Crossfade transition
-        f"[v0][v1]xfade=transition=fade:duration={fade_duration}:offset={fade_offset}[v];"
-        # Audio filter
-        f"[2:a]volume={volume}[a]",
+        *FFMPEG_BASE_ARGS,
+        *_hw_global_args(HW_ENCODER),
+        "-threads", "0", "-i", str(main_video),     # let decoders pick their thread count
+        "-threads", "0", *(["-stream_loop", "-1"] if loop_cta else []), "-i", str(cta_video),
+        "-i", _audio_input(audio),
+        "-filter_complex", _filter_graph(main_dur, volume, transition, fade_duration, cta_normalized),
         "-map", "[v]",
         "-map", "[a]",
         "-t", str(total_duration),              # total output duration
-        "-c:v", "libx264",
-        "-preset", "ultrafast",                # memory-efficient
-        "-crf", "28",                           # slightly lower quality for low RAM
-        "-pix_fmt", "yuv420p",
+        *_video_encode_args(HW_ENCODER),
         "-c:a", "aac",
         "-b:a", "128k",
         "-shortest",
+        "-movflags", "+faststart",              # moov up front so Cloudinary can start early
         str(out_mp4),
     ]
 
-    # Run ffmpeg
-    p = subprocess.run(cmd, capture_output=True, text=True)
-    if p.returncode != 0:
-        raise RuntimeError(f"FFmpeg failed:\n{p.stderr[-2000:]}")
+    await _run_ffmpeg(cmd, None if isinstance(audio, Path) else audio)
+
 
+async def _file_chunks(path: Path, head: bytes, tail: bytes):
+    yield head
+    with open(path, "rb") as f:
+        # Large reads in a worker thread keep disk I/O off the event loop
+        while chunk := await asyncio.to_thread(f.read, UPLOAD_CHUNK_SIZE):
+            yield chunk
+    yield tail
 
-def _upload_to_cloudinary(mp4_path: Path) -> str:
+
+async def _upload_to_cloudinary(client: httpx.AsyncClient, mp4_path: Path) -> str:
     if not CLOUD_NAME or not UPLOAD_PRESET:
         raise RuntimeError("Missing CLOUDINARY_CLOUD_NAME or CLOUDINARY_UPLOAD_PRESET env vars")
 
-    url = f"https://api.cloudinary.com/v1_1/{CLOUD_NAME}/video/upload"
     public_id = f"{FOLDER}/{uuid.uuid4().hex}"
+    fields = {
+        "upload_preset": UPLOAD_PRESET,
+        "public_id": public_id,
+        "resource_type": "video",
+    }
 
-    with open(mp4_path, "rb") as f:
-        files = {"file": f}
-        data = {
-            "upload_preset": UPLOAD_PRESET,
-            "public_id": public_id,
-            "resource_type": "video",
-        }
-        r = requests.post(url, files=files, data=data, timeout=120)
-        r.raise_for_status()
-        j = r.json()
-        if "secure_url" not in j:
-            raise RuntimeError(f"Cloudinary upload missing secure_url: {j}")
-        return j["secure_url"]
+    # Build the multipart envelope around the file once, then stream the file
+    # body between its head and tail with a known Content-Length
+    boundary = uuid.uuid4().hex
+    head = "".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in fields.items()
+    )
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{mp4_path.name}"\r\n'
+        "Content-Type: video/mp4\r\n\r\n"
+    )
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    head = head.encode()
+    headers = {
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + mp4_path.stat().st_size + len(tail)),
+    }
+
+    r = await client.post(UPLOAD_URL, content=_file_chunks(mp4_path, head, tail), headers=headers)
+    r.raise_for_status()
+    j = r.json()
+    if "secure_url" not in j:
+        raise RuntimeError(f"Cloudinary upload missing secure_url: {j}")
+    return j["secure_url"]
 
 
 @app.post("/merge")
-def merge(req: MergeRequest):
+async def merge(req: MergeRequest):
     try:
-        # Log the URLs to debug
-        print(f"Downloading main video from: {req.main_video_url}")
-        print(f"Downloading CTA video from: {req.cta_video_url}")
-        print(f"Downloading audio from: {req.audio_url}")
+        logger.debug("Downloading main video from: %s", req.main_video_url)
+        logger.debug("Downloading CTA video from: %s", req.cta_video_url)
+        logger.debug("Downloading audio from: %s", req.audio_url)
 
         main_duration = max(1, min(int(req.main_duration_sec), 58))
         cta_duration = max(1, min(int(req.cta_duration_sec), 58))
         volume = max(0.0, min(float(req.music_volume), 1.0))
 
-        with tempfile.TemporaryDirectory() as td:
+        with tempfile.TemporaryDirectory(dir=TMP_ROOT) as td:
             td = Path(td)
             main_video = td / "main.mp4"
-            cta_video = td / "cta.mp4"
-            audio_in = td / "music.mp3"
             out_mp4 = td / "out.mp4"
 
-            # Download the files
-            _download(req.main_video_url, main_video)
-            _download(req.cta_video_url, cta_video)
-            _download(req.audio_url, audio_in)
-
-            # Merge videos
-            _run_ffmpeg_two_videos(
-                main_video=main_video,
-                cta_video=cta_video,
-                audio_in=audio_in,
-                out_mp4=out_mp4,
-                main_dur=main_duration,
-                cta_dur=cta_duration,
-                volume=volume
+            session = app.state.http
+            results = await asyncio.gather(
+                _download(session, req.main_video_url, main_video),
+                _fetch_cta(session, req.cta_video_url, td / "cta.mp4"),
+                _fetch_seekable_audio(session, req.audio_url, td / "music"),
+                return_exceptions=True,
             )
+            for r in results:
+                if isinstance(r, BaseException):
+                    raise r
+            _, cta_video, audio_file = results
+
+            # The CTA probe drives the loop decision; the main clip only matters
+            # for the stream-copy check, which needs transition=false
+            if req.transition:
+                main_info, cta_info = {}, await asyncio.to_thread(_probe, cta_video)
+            else:
+                main_info, cta_info = await asyncio.gather(
+                    asyncio.to_thread(_probe, main_video),
+                    asyncio.to_thread(_probe, cta_video),
+                )
+            # Without a transition, inputs already in the output spec and sharing
+            # SPS/PPS can be stream-copied instead of re-encoded; this applies to a
+            # cached CTA too, which usually fails the parameter-set check
+            stream_copy = (
+                not req.transition
+                and _matches_output_spec(main_info)
+                and _matches_output_spec(cta_info)
+                and _same_parameter_sets(main_info, cta_info)
+                # The concat demuxer can't loop, so each clip must already cover its span
+                and (main_info["duration"] or 0) >= main_duration
+                and (cta_info["duration"] or 0) >= cta_duration
+            )
+
+            # Piped audio is only opened once an encode slot is held, so requests
+            # queued on the semaphore never sit on pooled connections
+            async with FFMPEG_SEM, contextlib.AsyncExitStack() as stack:
+                if audio_file is not None:
+                    audio = audio_file
+                else:
+                    # ffmpeg stops reading once it has enough audio, so only the start of
+                    # the song is transferred; don't return this half-read connection to
+                    # the pool, aiohttp can hand back a read-paused one
+                    audio_resp = await stack.enter_async_context(
+                        session.get(str(req.audio_url), headers={"Connection": "close"})
+                    )
+                    audio_resp.raise_for_status()
+                    audio = audio_resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE)
+
+                # Merge videos
+                if stream_copy:
+                    await _run_ffmpeg_concat_copy(
+                        main_video=main_video,
+                        cta_video=cta_video,
+                        audio=audio,
+                        out_mp4=out_mp4,
+                        main_dur=main_duration,
+                        cta_dur=cta_duration,
+                        volume=volume
+                    )
+                else:
+                    await _run_ffmpeg_two_videos(
+                        main_video=main_video,
+                        cta_video=cta_video,
+                        audio=audio,
+                        out_mp4=out_mp4,
+                        main_dur=main_duration,
+                        cta_dur=cta_duration,
+                        volume=volume,
+                        transition=req.transition,
+                        cta_source_dur=cta_info["duration"],
+                        cta_normalized=CTA_CACHE_DIR is not None
+                    )
 
-            final_url = _upload_to_cloudinary(out_mp4)
+            final_url = await _upload_to_cloudinary(app.state.upload, out_mp4)
 
         return {"final_url": final_url}
 
     except Exception as e:
-        print(f"Merge failed: {e}")  # Log any errors
+        logger.exception("Merge failed")
         raise HTTPException(status_code=500, detail=f"Merge failed: {str(e)}")